@@ -4,8 +4,6 @@ import shutil
 import sys
 from pathlib import Path
 
-from tesseract import ocr
-
 
 def get_config(path: str) -> None:
     if path is None:
@@ -61,6 +59,19 @@ def main() -> None:  # noqa: D103
         default="",
         help="Language identifier",
     )
+    pars_ocr.add_argument(
+        "--ocr-mode",
+        type=str,
+        choices=["auto", "force", "skip-text"],
+        default="auto",
+        help="auto: skip pages that already have a text layer, force: run OCR on\
+              all pages, skip-text: skip pages containing any text",
+    )
+    pars_ocr.add_argument(
+        "--verbose",
+        action="store_true",
+        help="Print the languages available to Tesseract",
+    )
 
     try:
         args = parser.parse_args()
@@ -87,8 +98,20 @@ def main() -> None:  # noqa: D103
             return
 
         if input_file.lower().endswith(".pdf") and output_file.lower().endswith(".pdf"):
+            # Imported only here, so --help and config do not load Pdfix SDK and
+            # Tesseract bindings
+            from tesseract import ocr
+
             try:
-                ocr(input_file, output_file, args.name, args.key, args.lang)
+                ocr(
+                    input_file,
+                    output_file,
+                    args.name,
+                    args.key,
+                    args.lang,
+                    args.ocr_mode,
+                    args.verbose,
+                )
             except Exception as e:
                 sys.exit("Failed to run OCR: {}".format(e))
 
@@ -1,26 +1,69 @@
+import functools
+import hashlib
 import os
 import tempfile
-import uuid
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from ctypes import c_ubyte
 
 import pytesseract
 from pdfixsdk.Pdfix import (
     GetPdfix,
-    PdfImageParams,
+    PdfDoc,
     Pdfix,
     PdfMatrix,
     PdfPage,
     PdfPageRenderParams,
+    PdsContent,
     kImageDIBFormatArgb,
-    kImageFormatJpg,
+    kPdsPageForm,
     kPdsPageText,
-    kPsTruncate,
     kRotate0,
     kSaveFull,
 )
+from PIL import Image
 from tqdm import tqdm
 
+try:
+    import tesserocr
+except ImportError:
+    tesserocr = None
+
 import utils
 
+# Pages are recognized concurrently, so keep the OpenMP threading of each
+# tesseract process started by pytesseract from oversubscribing the CPU. Read
+# by the process on start, can be overridden from the environment.
+os.environ.setdefault("OMP_THREAD_LIMIT", "1")
+
+# Number of pages rendered ahead of the pages being recognized
+RENDER_AHEAD = 4
+
+# Pages with more text objects than this are considered to have a text layer
+# already and are not recognized in "auto" mode
+TEXT_OBJECTS_THRESHOLD = 5
+
+# Resolution of pages rendered for OCR
+OCR_DPI = 300
+
+# Largest number of pixels of a page rendered for OCR, a page of A4 size is
+# about 8.7 million pixels at 300 DPI
+MAX_PIXELS = 12_000_000
+
+# Rotation part (a, b, c, d) of a matrix for page rotation of 0, 90, 180 and
+# 270 degrees
+ROTATION_MATRICES = (
+    (1, 0, 0, 1),
+    (0, 1, -1, 0),
+    (-1, 0, 0, -1),
+    (0, -1, 1, 0),
+)
+
+# Number of recognized page images remembered for reuse by identical pages
+OCR_CACHE_SIZE = 64
+
 
 class PdfixException(Exception):
     def __init__(self, message: str = "") -> None:
@@ -28,9 +71,56 @@ class PdfixException(Exception):
         self.add_note(message if len(message) else str(GetPdfix().GetError()))
 
 
-# Renders a PDF page into a temporary file, which then used for OCR
-def render_pages(page: PdfPage, pdfix: Pdfix, lang: str) -> bytes:
-    """Render a PDF page into a temporary file, which is then used for OCR.
+# List of available languages, spawns the tesseract binary so it is asked once
+@functools.lru_cache(maxsize=1)
+def _available_langs() -> list[str]:
+    return pytesseract.get_languages(config="")
+
+
+# Number of CPUs this process may run on, os.cpu_count() reports all CPUs of
+# the host even when a container is limited to some of them
+def _available_cpus() -> int:
+    if hasattr(os, "process_cpu_count"):
+        return os.process_cpu_count() or 1
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def count_text_objects(content: PdsContent, limit: int) -> int:
+    """Count text objects in the content, stop counting above the limit.
+
+    Text objects of nested forms are counted as well.
+
+    Parameters
+    ----------
+    content : PdsContent
+        The page or form content to be checked.
+    limit : int
+        Count at which the counting stops.
+
+    Returns
+    -------
+    int
+        Number of text objects, at most limit + 1.
+
+    """
+    count = 0
+    for j in range(content.GetNumObjects()):
+        obj = content.GetObject(j)
+        obj_type = obj.GetObjectType()
+        if obj_type == kPdsPageText:
+            count += 1
+        elif obj_type == kPdsPageForm:
+            count += count_text_objects(obj.GetContent(), limit - count)
+        if count > limit:
+            break
+    return count
+
+
+# Renders a PDF page into an in-memory image, which is then used for OCR
+def render_pages(page: PdfPage, pdfix: Pdfix, dpi: float) -> Image.Image:
+    """Render a PDF page into an in-memory image, which is then used for OCR.
 
     Parameters
     ----------
@@ -38,52 +128,240 @@ def render_pages(page: PdfPage, pdfix: Pdfix, lang: str) -> bytes:
         The PDF page to be processed for OCR.
     pdfix : Pdfix
         The Pdfix SDK object.
-    lang : str
-        The language identifier for OCR.
+    dpi : float
+        Resolution of the image, lowered for pages exceeding MAX_PIXELS.
 
     Returns
     -------
-    bytes
-        Raw PDF bytes.
+    Image.Image
+        Image of the page.
 
     """
-    zoom = 2.0
-    page_view = page.AcquirePageView(zoom, kRotate0)
-    if page_view is None:
-        raise PdfixException("Unable to acquire page view")
-
-    width = page_view.GetDeviceWidth()
-    height = page_view.GetDeviceHeight()
-    # Create an image
-    image = pdfix.CreateImage(width, height, kImageDIBFormatArgb)
-    if image is None:
-        raise PdfixException("Unable to create image")
-
-    # Render page
-    render_params = PdfPageRenderParams()
-    render_params.image = image
-    render_params.matrix = page_view.GetDeviceMatrix()
-    if not page.DrawContent(render_params):
-        raise PdfixException("Unable to draw content")
-
-    # Create temp file for rendering
-    with tempfile.NamedTemporaryFile() as tmp:
-        # Save image to file
-        stm = pdfix.CreateFileStream(tmp.name + ".jpg", kPsTruncate)
+    # Page area in square inches
+    crop_box = page.GetCropBox()
+    area = (crop_box.right - crop_box.left) * (crop_box.top - crop_box.bottom) / 72**2
+    if area <= 0:
+        raise PdfixException("Invalid page crop box")
+    zoom = min(dpi, (MAX_PIXELS / area) ** 0.5) / 72
+    # Pdfix objects are released as soon as the pixels are copied, not when
+    # collected by Python
+    with ExitStack() as stack:
+        page_view = page.AcquirePageView(zoom, kRotate0)
+        if page_view is None:
+            raise PdfixException("Unable to acquire page view")
+        stack.callback(page_view.Release)
+
+        width = page_view.GetDeviceWidth()
+        height = page_view.GetDeviceHeight()
+        # Create an image
+        image = pdfix.CreateImage(width, height, kImageDIBFormatArgb)
+        if image is None:
+            raise PdfixException("Unable to create image")
+        stack.callback(image.Destroy)
+
+        # Render page
+        render_params = PdfPageRenderParams()
+        render_params.image = image
+        render_params.matrix = page_view.GetDeviceMatrix()
+        if not page.DrawContent(render_params):
+            raise PdfixException("Unable to draw content")
+
+        # Copy raw pixels of the image
+        stm = pdfix.CreateMemStream()
         if stm is None:
-            raise PdfixException("Unable to create file stream")
+            raise PdfixException("Unable to create memory stream")
+        stack.callback(stm.Destroy)
+
+        if not image.SaveDataToStream(stm):
+            raise PdfixException("Unable to save image data to stream")
+
+        data = utils.ps_stream_read(stm)
+        if data is None:
+            raise PdfixException("Unable to read image data from stream")
+
+    # Keep the colors, Tesseract binarizes colored backgrounds better by itself
+    return Image.frombuffer("RGB", (width, height), data, "raw", "BGRX", 0, 1)
+
+
+class TesseractEngine:
+    """Tesseract OCR that keeps the language models loaded across pages.
+
+    With tesserocr available, each worker thread initializes its own Tesseract
+    API once and reuses it for all following pages. Otherwise pytesseract runs
+    the tesseract binary for every batch of pages.
+
+    Parameters
+    ----------
+    lang : str
+        The language identifier for OCR.
+
+    """
+
+    def __init__(self, lang: str) -> None:
+        self.lang = lang
+        self.local = threading.local()
+        self.apis = []
+
+    def __enter__(self) -> "TesseractEngine":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """Release the Tesseract APIs of all worker threads."""
+        for api in self.apis:
+            api.End()
+        self.apis.clear()
+
+    def ocr_images(self, images: list[Image.Image]) -> bytes:
+        """Run Tesseract OCR on rendered page images in a single run.
+
+        Does not touch any Pdfix object, so it is safe to run in a worker thread.
+
+        Parameters
+        ----------
+        images : list[Image.Image]
+            The rendered page images.
+
+        Returns
+        -------
+        bytes
+            Raw PDF bytes with one page per image.
+
+        """
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # The pages reach Tesseract as one uncompressed multi-page TIFF, only
+            # the text layer is requested back since the images are not used
+            image_path = os.path.join(tmp_dir, "pages.tif")
+            images[0].save(image_path, save_all=True, append_images=images[1:])
+
+            if tesserocr is None:
+                return pytesseract.image_to_pdf_or_hocr(
+                    image_path,
+                    extension="pdf",
+                    lang=self.lang,
+                    config="-c textonly_pdf=1",
+                )
+
+            api = getattr(self.local, "api", None)
+            if api is None:
+                api = tesserocr.PyTessBaseAPI(lang=self.lang, psm=tesserocr.PSM.AUTO)
+                api.SetVariable("tessedit_create_pdf", "1")
+                api.SetVariable("textonly_pdf", "1")
+                self.apis.append(api)
+                self.local.api = api
+
+            # The PDF renderer of tesserocr produces a complete document only
+            # when processing image files
+            output_base = os.path.join(tmp_dir, "pages")
+            if not api.ProcessPages(output_base, image_path):
+                raise Exception("Tesseract failed to process pages")
+
+            with open(output_base + ".pdf", "rb") as f:
+                return f.read()
+
+
+def add_ocr_layer(
+    doc: PdfDoc,
+    page: PdfPage,
+    temp_pdf: bytes,
+    temp_page_index: int,
+    pdfix: Pdfix,
+) -> None:
+    """Place the text layer of the PDF generated by the OCR onto a page.
+
+    Parameters
+    ----------
+    doc : PdfDoc
+        The processed PDF document.
+    page : PdfPage
+        The page of the document the OCR was run on.
+    temp_pdf : bytes
+        Raw PDF bytes generated by the OCR.
+    temp_page_index : int
+        Index of the page in the PDF generated by the OCR.
+    pdfix : Pdfix
+        The Pdfix SDK object.
+
+    """
+    with ExitStack() as stack:
+        # Open the pdf generated by the OCR from memory, the stream has to
+        # outlive the document
+        stm = pdfix.CreateMemStream()
+        if stm is None:
+            raise PdfixException("Unable to create memory stream")
+        stack.callback(stm.Destroy)
+        size = len(temp_pdf)
+        if not stm.Write(0, (c_ubyte * size).from_buffer_copy(temp_pdf), size):
+            raise PdfixException("Unable to write to memory stream")
+
+        temp_doc = pdfix.OpenDocFromStream(stm, "")
+        if temp_doc is None:
+            raise Exception("Unable to open pdf : " + str(pdfix.GetError()))
+        stack.callback(temp_doc.Close)
 
-        img_params = PdfImageParams()
-        img_params.format = kImageFormatJpg
-        img_params.quality = 100
-        if not image.SaveToStream(stm, img_params):
-            raise PdfixException("Unable to save image to stream")
+        temp_page = temp_doc.AcquirePage(temp_page_index)
+        if temp_page is None:
+            raise PdfixException("Unable to acquire page")
+        stack.callback(temp_page.Release)
 
-        return pytesseract.image_to_pdf_or_hocr(
-            tmp.name + ".jpg",
-            extension="pdf",
-            lang=lang,
-        )
+        temp_page_box = temp_page.GetCropBox()
+
+        # Tesseract is asked for a text only PDF, remove other then text page
+        # objects in case it still contains some and rewrite the content only then
+        temp_page_content = temp_page.GetContent()
+        other_objects = []
+        for j in range(temp_page_content.GetNumObjects()):
+            obj = temp_page_content.GetObject(j)
+            if obj.GetObjectType() != kPdsPageText:
+                other_objects.append(obj)
+
+        if other_objects:
+            for obj in other_objects:
+                temp_page_content.RemoveObject(obj)
+            temp_page.SetContent()
+
+        xobj = doc.CreateXObjectFromPage(temp_page)
+        if xobj is None:
+            raise Exception(
+                "Failed to create XObject from page: " + str(pdfix.GetError()),
+            )
+
+    crop_box = page.GetCropBox()
+    # Page rotation in multiples of 90 degrees
+    rotate = page.GetRotate() // 90 % 4
+
+    width = crop_box.right - crop_box.left
+    width_tmp = temp_page_box.right - temp_page_box.left
+    height = crop_box.top - crop_box.bottom
+    height_tmp = temp_page_box.top - temp_page_box.bottom
+
+    if rotate % 2:
+        width_tmp, height_tmp = height_tmp, width_tmp
+
+    scale_x = width / width_tmp
+    scale_y = height / height_tmp
+
+    # Calculate matrix for placing xObject on a page: rotate, scale and move
+    # to the crop box corner that is the origin of the rotated page
+    a, b, c, d = ROTATION_MATRICES[rotate]
+    matrix = PdfMatrix()
+    matrix.a = a * scale_x
+    matrix.b = b * scale_y
+    matrix.c = c * scale_x
+    matrix.d = d * scale_y
+    matrix.e, matrix.f = (
+        (crop_box.left, crop_box.bottom),
+        (crop_box.right, crop_box.bottom),
+        (crop_box.right, crop_box.top),
+        (crop_box.left, crop_box.top),
+    )[rotate]
+
+    content = page.GetContent()
+    form = content.AddNewForm(-1, xobj, matrix)
+    if form is None:
+        raise Exception("Failed to add xobject to page: " + str(Pdfix.GetError()))
 
 
 def ocr(
@@ -92,6 +370,8 @@ def ocr(
     license_name: str,
     license_key: str,
     lang: str,
+    ocr_mode: str = "auto",
+    verbose: bool = False,
 ) -> None:
     """Run OCR using Tesseract.
 
@@ -107,10 +387,16 @@ def ocr(
         Pdfix SDK license key.
     lang : str, optional
         Language identifier for OCR Tesseract. Default value: "eng".
+    ocr_mode : str, optional
+        "force" recognizes all pages, "skip-text" skips pages containing any
+        text, "auto" skips pages that already have a text layer.
+        Default value: "auto".
+    verbose : bool, optional
+        Print the languages available to Tesseract. Default value: False.
 
     """
-    # List of available languages
-    print("Available config files: {}".format(pytesseract.get_languages(config="")))
+    if verbose:
+        print("Available config files: {}".format(_available_langs()))
 
     pdfix = GetPdfix()
     if pdfix is None:
@@ -135,107 +421,103 @@ def ocr(
 
     print(f"Using langauge: {lang}")
 
+    concurrency_env = os.environ.get("OCR_CONCURRENCY")
+    concurrency = max(1, int(concurrency_env) if concurrency_env else _available_cpus())
+    # tesserocr keeps the language models loaded, batching pages pays off only
+    # when the tesseract binary is started for every batch
+    batch_size = max(
+        1, int(os.environ.get("OCR_BATCH_SIZE", "1" if tesserocr else "4"))
+    )
+    max_in_flight = concurrency * batch_size + RENDER_AHEAD
+
     doc_num_pages = doc.GetNumPages()
 
-    # Process each page
-    for i in tqdm(range(doc_num_pages), desc="Processing pages"):
-        page = doc.AcquirePage(i)
-        if page is None:
-            raise PdfixException("Unable to acquire page")
+    # Pdfix is not thread-safe, so pages are rendered and merged in this thread
+    # and only the Tesseract calls run in the pool. Rendering of the following
+    # pages overlaps with the OCR of the previous ones.
+    with (
+        TesseractEngine(lang) as engine,
+        ThreadPoolExecutor(max_workers=concurrency) as executor,
+        tqdm(total=doc_num_pages, desc="Processing pages") as progress,
+    ):
+        pending = deque()
+        cache = OrderedDict()
+        # Pages waiting for the batch to be filled
+        batch = []
+        batch_images = []
+        batch_digests = {}
+
+        def merge_next() -> None:
+            page, future, index = pending.popleft()
+            add_ocr_layer(doc, page, future.result(), index, pdfix)
+            progress.update()
+
+        def submit_batch() -> None:
+            future = executor.submit(engine.ocr_images, list(batch_images))
+            for digest, index in batch_digests.items():
+                cache[digest] = (future, index)
+                if len(cache) > OCR_CACHE_SIZE:
+                    cache.popitem(last=False)
+            pending.extend((page, future, index) for page, index in batch)
+            batch.clear()
+            batch_images.clear()
+            batch_digests.clear()
 
         try:
-            temp_pdf = render_pages(page, pdfix, lang)
-        except Exception as e:
-            raise e
-
-        temp_path = (
-            tempfile.gettempdir() + str(uuid.uuid4()) + ".pdf"
-        )  # temporary file for pdf generated by the OCR
-        with open(temp_path, "w+b") as f:
-            f.write(temp_pdf)
-
-        temp_doc = pdfix.OpenDoc(temp_path, "")
-
-        if temp_doc is None:
-            raise Exception("Unable to open pdf : " + str(pdfix.GetError()))
-
-        # There is always only one page in the new PDF file
-        temp_page = temp_doc.AcquirePage(0)
-        temp_page_box = temp_page.GetCropBox()
-
-        # Remove other then text page objects from the page content
-        temp_page_content = temp_page.GetContent()
-        for j in reversed(range(temp_page_content.GetNumObjects())):
-            obj = temp_page_content.GetObject(j)
-            obj_type = obj.GetObjectType()
-            if obj_type != kPdsPageText:
-                temp_page_content.RemoveObject(obj)
-
-        temp_page.SetContent()
-
-        xobj = doc.CreateXObjectFromPage(temp_page)
-        if xobj is None:
-            raise Exception(
-                "Failed to create XObject from page: " + str(pdfix.GetError()),
-            )
-
-        temp_page.Release()
-        temp_doc.Close()
-
-        os.remove(temp_path)
-
-        crop_box = page.GetCropBox()
-        rotate = page.GetRotate()
-
-        width = crop_box.right - crop_box.left
-        width_tmp = temp_page_box.right - temp_page_box.left
-        height = crop_box.top - crop_box.bottom
-        height_tmp = temp_page_box.top - temp_page_box.bottom
-
-        if rotate == 90 or rotate == 270:
-            width_tmp, height_tmp = height_tmp, width_tmp
-
-        scale_x = width / width_tmp
-        scale_y = height / height_tmp
-
-        # Calculate matrix for placing xObject on a page
-        rotate = (page.GetRotate() / 90) % 4
-        matrix = PdfMatrix()
-        matrix = utils.pdf_matrix_rotate(matrix, rotate * utils.pi / 2, False)
-        matrix = utils.pdf_matrix_scale(matrix, scale_x, scale_y, False)
-        if rotate == 0:
-            matrix = utils.pdf_matrix_translate(
-                matrix,
-                crop_box.left,
-                crop_box.bottom,
-                False,
-            )
-        elif rotate == 1:
-            matrix = utils.pdf_matrix_translate(
-                matrix,
-                crop_box.right,
-                crop_box.bottom,
-                False,
-            )
-        elif rotate == 2:
-            matrix = utils.pdf_matrix_translate(
-                matrix,
-                crop_box.right,
-                crop_box.top,
-                False,
-            )
-        elif rotate == 3:
-            matrix = utils.pdf_matrix_translate(
-                matrix,
-                crop_box.left,
-                crop_box.top,
-                False,
-            )
-
-        content = page.GetContent()
-        form = content.AddNewForm(-1, xobj, matrix)
-        if form is None:
-            raise Exception("Failed to add xobject to page: " + str(Pdfix.GetError()))
-
+            for i in range(doc_num_pages):
+                # Merge pages that are already recognized, wait for the oldest one
+                # when too many pages are rendered ahead of the OCR
+                while pending and (
+                    pending[0][1].done() or len(pending) + len(batch) >= max_in_flight
+                ):
+                    merge_next()
+
+                page = doc.AcquirePage(i)
+                if page is None:
+                    raise PdfixException("Unable to acquire page")
+
+                limit = 0 if ocr_mode == "skip-text" else TEXT_OBJECTS_THRESHOLD
+                has_text = count_text_objects(page.GetContent(), limit) > limit
+                if has_text and ocr_mode != "force":
+                    progress.update()
+                    continue
+
+                image = render_pages(page, pdfix, OCR_DPI)
+
+                # Pages rendering into identical images (blank separators, repeated
+                # covers or boilerplate) are recognized only once. The size is part
+                # of the key, portrait and landscape pages can share the pixels.
+                h = hashlib.blake2b(digest_size=16)
+                h.update(repr((image.mode, image.size)).encode())
+                h.update(image.tobytes())
+                digest = h.digest()
+                if digest in cache:
+                    cache.move_to_end(digest)
+                    pending.append((page, *cache[digest]))
+                    continue
+
+                index = batch_digests.get(digest)
+                if index is None:
+                    index = len(batch_images)
+                    batch_images.append(image)
+                    batch_digests[digest] = index
+                batch.append((page, index))
+
+                if len(batch_images) == batch_size:
+                    submit_batch()
+
+            if batch:
+                submit_batch()
+
+            while pending:
+                merge_next()
+        except BaseException:
+            # Do not wait for the OCR of queued batches when a page fails
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
+
+    # Saving takes a fraction of the OCR time and Pdfix is not thread safe,
+    # so the document is saved synchronously once all layers are merged
     if not doc.Save(output_path, kSaveFull):
         raise Exception("Unable to save pdf : " + str(pdfix.GetError()))
+    doc.Close()
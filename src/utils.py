@@ -2,8 +2,9 @@
 # Pdfix utils
 
 import math
+from ctypes import c_ubyte
 
-from pdfixsdk.Pdfix import PdfMatrix
+from pdfixsdk.Pdfix import PdfMatrix, PsStream
 
 pi = 3.1415926535897932384626433832795
 
@@ -72,6 +73,27 @@ def pdf_matrix_scale(m: PdfMatrix, sx: float, sy: float, prepend: bool) -> PdfMa
     return m
 
 
+def ps_stream_read(stm: PsStream) -> bytearray | None:
+    """Read the whole content of a Pdfix stream.
+
+    Parameters
+    ----------
+    stm : PsStream
+        Stream to read.
+
+    Returns
+    -------
+    bytearray | None:
+        Content of the stream or None if the stream could not be read.
+
+    """
+    size = stm.GetSize()
+    data = bytearray(size)
+    if not stm.Read(0, (c_ubyte * size).from_buffer(data), size):
+        return None
+    return data
+
+
 # Mapping from ISO 639-1 language codes to Tesseract language identifiers
 iso_to_tesseract = {
     "af": "afr",  # Afrikaans
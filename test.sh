@@ -70,6 +70,15 @@ else
   EXIT_STATUS=1
 fi
 
+info "Test #04: Run ocr-tesseract with --ocr-mode force"
+docker run -v $(pwd):/data -w /data $img ocr -i example/climate_change.pdf -o $tmp_dir/climate_change_ocr_force.pdf --ocr-mode force > /dev/null
+if [ -f "$(pwd)/$tmp_dir/climate_change_ocr_force.pdf" ]; then
+  success "passed"
+else
+  error "ocr-tesseract --ocr-mode force failed on example/climate_change.pdf"
+  EXIT_STATUS=1
+fi
+
 popd > /dev/null
 
 if [ $EXIT_STATUS -eq 1 ]; then